@@ -1,26 +1,244 @@
 import os
+import re
+import json
+import stat
 import time
+import tempfile
+import hashlib
 import uuid
 import logging
 from datetime import datetime, timezone
+from typing import Optional
 import asyncio
-from fastapi import FastAPI, BackgroundTasks, Request, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import AnyHttpUrl, BaseModel, ConfigDict
 import asyncpg
 import hvac
-from playwright.async_api import async_playwright
+import orjson
+import redis.asyncio as aioredis
+from playwright.async_api import async_playwright, Browser, Playwright
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Cookie Scanner Service")
+# Serializes asyncpg Records straight to JSON bytes. Handlers return this
+# directly to skip jsonable_encoder. orjson handles datetime natively but only
+# the exact uuid.UUID type, and asyncpg decodes uuid columns to a subclass.
+def _orjson_default(o):
+    if isinstance(o, asyncpg.Record):
+        return dict(o)
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    raise TypeError
+
+class RecordJSONResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_orjson_default)
+
+app = FastAPI(title="Cookie Scanner Service", default_response_class=RecordJSONResponse)
 pool: asyncpg.Pool = None
 
+# SCANNER_ROLE picks what this process does: "api" only serves HTTP and
+# enqueues scans, "worker" only consumes the queue, "all" (default) does both.
+SCANNER_ROLE = os.getenv("SCANNER_ROLE", "all")
+RUNS_WORKER = SCANNER_ROLE in ("worker", "all")
+
+# Scans are queued durably in cookie_scans (status = 'pending') and announced
+# on this channel. A NOTIFY only wakes the worker: whenever a SCAN_SEM slot is
+# free it claims the oldest pending scan with SKIP LOCKED, and idle workers
+# also poll every SWEEP_INTERVAL in case a notification was missed. A periodic
+# sweep requeues scans whose worker died.
+SCAN_CHANNEL = "scan_enqueue"
+STALE_SCAN_AFTER = int(os.getenv("STALE_SCAN_AFTER_SECONDS", "900"))
+SWEEP_INTERVAL = int(os.getenv("SCAN_SWEEP_INTERVAL_SECONDS", "60"))
+# A scan whose worker keeps dying (e.g. Chromium OOM on that URL) is failed
+# instead of requeued once it has been claimed this many times
+MAX_SCAN_ATTEMPTS = int(os.getenv("MAX_SCAN_ATTEMPTS", "3"))
+# A scan gives up well before the sweep would consider it stale, leaving a
+# minute for the finish write
+SCAN_TIMEOUT = min(int(os.getenv("SCAN_TIMEOUT_SECONDS", "600")), STALE_SCAN_AFTER - 60)
+listen_dsn: str = None
+listen_conn: asyncpg.Connection = None
+relisten: asyncio.Task = None
+consumer: asyncio.Task = None
+sweeper: asyncio.Task = None
+_scan_wakeup = asyncio.Event()
+shutting_down = False
+_listen_lock = asyncio.Lock()
+
+# Optional: with REDIS_URL set, identical (tenant, url) submissions within
+# SCAN_DEDUP_TTL seconds return the existing scan instead of starting another.
+# Redis errors fall through to the normal path.
+REDIS_URL = os.getenv("REDIS_URL", "")
+SCAN_DEDUP_TTL = int(os.getenv("SCAN_DEDUP_TTL_SECONDS", "60"))
+# A burst can hit the key before the first request's INSERT commits
+SCAN_DEDUP_FETCH_RETRIES = 5
+SCAN_DEDUP_FETCH_DELAY = 0.05
+redis_client: aioredis.Redis = None
+
+# One Chromium process is shared by every scan; each scan gets its own
+# BrowserContext. Relaunched under the lock if it crashes or is OOM-killed.
+playwright: Playwright = None
+browser: Browser = None
+_browser_lock = asyncio.Lock()
+
+# Caps concurrent scans (browser contexts + DB work) so bursts queue up
+# instead of exhausting memory or the connection pool.
+MAX_CONCURRENT_SCANS = int(os.getenv("MAX_CONCURRENT_SCANS", "4"))
+SCAN_SEM = asyncio.Semaphore(MAX_CONCURRENT_SCANS)
+
+# Scans claimed by this process and currently running, keyed by id
+SCAN_TASKS: dict = {}
+
+# ── SQL ──────────────────────────────────────────────────────────────────────
+# asyncpg keeps an LRU of prepared statements per connection keyed by query
+# text, so each of these is parsed/planned once per pooled connection and then
+# reused by every handler. Keep them as constants so the text never varies.
+STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100"))
+
+# Insert and notify in one statement; the NOTIFY is delivered on commit
+SQL_CREATE_SCAN = f"""
+    WITH scan AS (
+        INSERT INTO cookie_scans (id, tenant_id, url, status, created_at, updated_at)
+        VALUES ($1, $2, $3, 'pending', NOW(), NOW())
+        RETURNING *
+    )
+    SELECT scan.* FROM scan, LATERAL pg_notify('{SCAN_CHANNEL}', scan.id::text) AS n
+"""
+
+# Claims the oldest pending scan; SKIP LOCKED lets concurrent workers each
+# take a different row instead of contending on the same one
+SQL_CLAIM_NEXT_SCAN = """
+    UPDATE cookie_scans 
+    SET status = 'running', started_at = $1, updated_at = $1, attempts = attempts + 1
+    WHERE id = (
+        SELECT id FROM cookie_scans 
+        WHERE status = 'pending' 
+        ORDER BY created_at 
+        FOR UPDATE SKIP LOCKED 
+        LIMIT 1
+    )
+    RETURNING id, url, attempts
+"""
+
+SQL_REQUEUE_STALE_SCANS = """
+    UPDATE cookie_scans 
+    SET status       = CASE WHEN attempts >= $2 THEN 'failed' ELSE 'pending' END,
+        error        = CASE WHEN attempts >= $2
+                            THEN 'Scan abandoned after ' || attempts || ' interrupted attempts'
+                            ELSE error END,
+        started_at   = CASE WHEN attempts >= $2 THEN started_at ELSE NULL END,
+        completed_at = CASE WHEN attempts >= $2 THEN NOW() ELSE completed_at END
+    WHERE status = 'running' AND started_at < NOW() - make_interval(secs => $1)
+"""
+
+# Hands scans this process claimed but won't finish back to the queue without
+# spending an attempt, and wakes the remaining workers to pick them up
+SQL_RELEASE_SCANS = f"""
+    WITH released AS (
+        UPDATE cookie_scans 
+        SET status = 'pending', started_at = NULL, attempts = attempts - 1
+        WHERE id = ANY($1) AND status = 'running'
+        RETURNING id
+    )
+    SELECT pg_notify('{SCAN_CHANNEL}', id::text) FROM released
+"""
+
+# Fenced on the claim's attempt so a worker whose scan was requeued by the
+# stale sweep can't overwrite the newer run
+SQL_FINISH_SCAN = """
+    UPDATE cookie_scans 
+    SET status = $2, error = $3, completed_at = $4, updated_at = $4
+    WHERE id = $1 AND status = 'running' AND attempts = $5
+"""
+
+# First page and next pages are separate statements: a single one with an
+# optional "$2 IS NULL OR ..." cursor can't use the index condition once
+# Postgres switches the cached statement to a generic plan.
+SQL_LIST_SCANS_FIRST = """
+    SELECT id, url, status, created_at, completed_at FROM cookie_scans 
+    WHERE tenant_id = $1 
+    ORDER BY created_at DESC, id DESC 
+    LIMIT $2
+"""
+
+SQL_LIST_SCANS_NEXT = """
+    SELECT id, url, status, created_at, completed_at FROM cookie_scans 
+    WHERE tenant_id = $1 AND (created_at, id) < ($2, $3)
+    ORDER BY created_at DESC, id DESC 
+    LIMIT $4
+"""
+
+SQL_GET_SCAN = "SELECT * FROM cookie_scans WHERE id = $1"
+
+SQL_GET_COOKIES = """
+    SELECT * FROM scanned_cookies 
+    WHERE scan_id = $1 
+    ORDER BY category, name
+"""
+
+# Vault lookups are cached per (vault_addr, secret_path) so restarts and forked
+# workers reuse the DSN instead of round-tripping to Vault every time.
+PG_URL_CACHE_TTL = int(os.getenv("PG_URL_CACHE_TTL", "600"))
+PG_URL_CACHE_FILE = os.getenv("PG_URL_CACHE_FILE", "/tmp/arc-cookie-scanner-dsn.json")
+_pg_url_cache: dict = {}
+
+def _read_cached_pg_url(key: str):
+    hit = _pg_url_cache.get(key)
+    if hit and hit[1] > time.time():
+        return hit[0]
+    try:
+        # The cache lives in a shared directory and the DSN picks which database
+        # we connect to, so only trust a regular file (not a symlink) that we
+        # own and nobody else can read or write
+        fd = os.open(PG_URL_CACHE_FILE, os.O_RDONLY | os.O_NOFOLLOW)
+        with os.fdopen(fd) as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+                logger.warning(f"Ignoring untrusted PG_URL cache file {PG_URL_CACHE_FILE}")
+                return None
+            # The file's TTL runs from when it was written, not from when we read it
+            expires_at = st.st_mtime + PG_URL_CACHE_TTL
+            if expires_at <= time.time():
+                return None
+            url = json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+    if url:
+        _pg_url_cache[key] = (url, expires_at)
+    return url
+
+def _write_cached_pg_url(key: str, url: str):
+    _pg_url_cache[key] = (url, time.time() + PG_URL_CACHE_TTL)
+    tmp_path = None
+    try:
+        # mkstemp creates a fresh 0600 file we own; os.replace then swaps it in
+        # atomically without following whatever currently sits at the path
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(PG_URL_CACHE_FILE) or ".", prefix=".arc-cookie-scanner-dsn-"
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump({key: url}, f)
+        os.replace(tmp_path, PG_URL_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Failed to persist PG_URL cache: {e}")
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
 # Connect to Vault for secrets
 def get_pg_url():
     vault_addr = os.getenv("VAULT_ADDR", "http://localhost:8200")
     vault_token = os.getenv("VAULT_TOKEN", "root")
     secret_path = os.getenv("VAULT_SECRET_PATH", "secret/data/arc/cookie-scanner")
+
+    cache_key = f"{vault_addr}|{secret_path}"
+    cached = _read_cached_pg_url(cache_key)
+    if cached:
+        return cached
     
     try:
         client = hvac.Client(url=vault_addr, token=vault_token)
@@ -32,6 +250,7 @@ def get_pg_url():
         url = data.get("PG_URL")
         if not url:
             raise Exception("PG_URL missing in Vault")
+        _write_cached_pg_url(cache_key, url)
         return url
     except Exception as e:
         logger.error(f"Failed to fetch secrets from vault: {e}")
@@ -40,153 +259,381 @@ def get_pg_url():
 
 @app.on_event("startup")
 async def startup():
-    global pool
+    global pool, redis_client
     pg_url = get_pg_url()
     try:
-        pool = await asyncpg.create_pool(dsn=pg_url, min_size=2, max_size=10)
+        # A larger pool (25-50) keeps burst latency flat under concurrent scans and
+        # API reads, at the cost of more idle backends on Postgres. Idle
+        # connections are recycled after 5 min and every connection after 50k
+        # queries to avoid stale-connection stalls; min_size is opened eagerly.
+        pool = await asyncpg.create_pool(
+            dsn=pg_url,
+            min_size=int(os.getenv("PG_POOL_MIN", "5")),
+            max_size=int(os.getenv("PG_POOL_MAX", "25")),
+            max_inactive_connection_lifetime=300,
+            max_queries=50000,
+            command_timeout=30,
+            statement_cache_size=STATEMENT_CACHE_SIZE,
+        )
         logger.info("Connected to PostgreSQL successfully")
     except Exception as e:
         logger.fatal(f"Failed to connect to postgres: {e}")
 
+    if REDIS_URL:
+        # Short timeouts so a Redis outage can't stall POST /scans
+        redis_client = aioredis.from_url(
+            REDIS_URL, decode_responses=True, socket_timeout=0.5, socket_connect_timeout=0.5
+        )
+
+    if RUNS_WORKER:
+        await start_worker(pg_url)
+
+async def start_worker(pg_url: str):
+    global playwright, listen_dsn, consumer, sweeper
+    try:
+        playwright = await async_playwright().start()
+        await _launch_browser()
+    except Exception as e:
+        # Without a browser every claimed scan would fail, so stay off the
+        # queue and leave the work to healthy workers
+        logger.fatal(f"Failed to launch Chromium, not consuming scans: {e}")
+        return
+
+    listen_dsn = pg_url
+    await _ensure_listening()
+    consumer = asyncio.create_task(_consume_scans())
+    sweeper = asyncio.create_task(_sweep_stale_scans())
+
+async def _launch_browser():
+    global browser
+    browser = await playwright.chromium.launch(
+        headless=True,
+        args=[
+            '--disable-blink-features=AutomationControlled',
+            '--no-sandbox',
+            '--disable-dev-shm-usage',
+            '--disable-gpu',
+            '--disable-setuid-sandbox',
+            '--disable-web-security',
+        ]
+    )
+    browser.on("disconnected", _on_browser_disconnected)
+    logger.info("Launched shared Chromium browser")
+
+def _on_browser_disconnected(_):
+    if not shutting_down:
+        logger.error("Shared Chromium browser disconnected; relaunching before the next claim")
+
+# True when a live browser is available, relaunching a dead one if needed
+async def _ensure_browser() -> bool:
+    async with _browser_lock:
+        if browser and browser.is_connected():
+            return True
+        try:
+            await _launch_browser()
+            return True
+        except Exception as e:
+            logger.error(f"Failed to relaunch Chromium, not consuming scans: {e}")
+            return False
+
 @app.on_event("shutdown")
 async def shutdown():
+    global shutting_down
+    shutting_down = True
+    if consumer:
+        consumer.cancel()
+    if sweeper:
+        sweeper.cancel()
+    if relisten:
+        relisten.cancel()
+    claimed = list(SCAN_TASKS.items())
+    for _, task in claimed:
+        task.cancel()
+    if claimed:
+        # Let cancelled finish writes roll back before releasing their scans
+        await asyncio.gather(*(task for _, task in claimed), return_exceptions=True)
+        try:
+            await pool.execute(SQL_RELEASE_SCANS, [uuid.UUID(scan_id) for scan_id, _ in claimed])
+        except Exception as e:
+            # They stay 'running' and the sweep requeues them once stale
+            logger.warning(f"Failed to release {len(claimed)} interrupted scans: {e}")
+    if listen_conn:
+        await listen_conn.close()
+    if redis_client:
+        await redis_client.aclose()
+    if browser:
+        await browser.close()
+    if playwright:
+        await playwright.stop()
     if pool:
         await pool.close()
 
+# Category keyword sets, checked in priority order (first category to match wins)
+_COOKIE_CATEGORY_KEYWORDS = [
+    ("Analytics", ['_ga', '_gid', '_gat', 'utma', 'utmb', 'utmc', 'utmz', '_hjid', '_hjsession', '_hjincluded']),
+    ("Marketing", ['fbp', '_fbc', 'ide', 'test_cookie', 'muid', 'anonchk', '_ttp', 'fr_']),
+    ("Functional", ['lang', 'locale', 'language', 'seen_cookie', 'cookie_notice', 'cookie_consent', 'gdpr']),
+    ("Necessary", ['session', 'csrf', 'xsrf', 'jsessionid', 'phpsessid', 'asp.net_', 'cf_clearance', '__cfduid', 'token', 'auth']),
+]
+_COOKIE_CATEGORY_RES = [
+    (category, re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE))
+    for category, keywords in _COOKIE_CATEGORY_KEYWORDS
+]
+
 def categorize_cookie(name: str) -> str:
-    n = name.lower()
-    for s in ['_ga', '_gid', '_gat', 'utma', 'utmb', 'utmc', 'utmz', '_hjid', '_hjsession', '_hjincluded']:
-        if s in n: return "Analytics"
-    for s in ['fbp', '_fbc', 'ide', 'test_cookie', 'muid', 'anonchk', '_ttp', 'fr_']:
-        if s in n: return "Marketing"
-    for s in ['lang', 'locale', 'language', 'seen_cookie', 'cookie_notice', 'cookie_consent', 'gdpr']:
-        if s in n: return "Functional"
-    for s in ['session', 'csrf', 'xsrf', 'jsessionid', 'phpsessid', 'asp.net_', 'cf_clearance', '__cfduid', 'token', 'auth']:
-        if s in n: return "Necessary"
+    for category, pattern in _COOKIE_CATEGORY_RES:
+        if pattern.search(name): return category
     return "Unknown"
 
-async def scan_worker(scan_id: str, target_url: str):
+# RFC 4122 v4 UUIDs carved from a single os.urandom call (one syscall per
+# scan instead of one per cookie)
+def _bulk_uuid4(n: int):
+    buf = bytearray(os.urandom(16 * n))
+    for i in range(0, 16 * n, 16):
+        buf[i + 6] = (buf[i + 6] & 0x0F) | 0x40
+        buf[i + 8] = (buf[i + 8] & 0x3F) | 0x80
+        yield uuid.UUID(bytes=bytes(buf[i:i + 16]))
+
+# Map down Playwright cookies straight to scanned_cookies COPY rows. Hot
+# globals are bound to locals once, outside the per-cookie loop. source and
+# description are constant for these rows and come from column defaults
+# (migration 000003), so they're left out of the payload entirely.
+def _cookie_rows(scan_uuid: uuid.UUID, raw_cookies: list):
+    _cat = categorize_cookie
+    _fromtimestamp = datetime.fromtimestamp
+    _utc = timezone.utc
+    for cookie_id, c in zip(_bulk_uuid4(len(raw_cookies)), raw_cookies):
+        get = c.get
+        name = get('name', '')
+        expires = get('expires', -1)
+        yield (
+            cookie_id, scan_uuid, name, get('domain', ''), get('path', '/'), get('value', ''),
+            _fromtimestamp(expires, _utc) if expires > 0 else None,
+            bool(get('secure')), bool(get('httpOnly')), str(get('sameSite', '')),
+            _cat(name),
+        )
+
+# Only cookies matter, so skip heavy assets. Documents, scripts, XHR/fetch and
+# beacons still load so trackers fire normally. Images are only blocked for
+# static formats: tracking pixels (extensionless or .gif) set third-party
+# cookies and must still be requested.
+BLOCKED_RESOURCE_TYPES = {"media", "font", "stylesheet"}
+BLOCKED_IMAGE_RE = re.compile(r"\.(?:png|jpe?g|webp|avif|svg|ico|bmp)(?:$|[?#])", re.IGNORECASE)
+
+async def _block_heavy_resources(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or (
+        request.resource_type == "image" and BLOCKED_IMAGE_RE.search(request.url)
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+def _on_scan_enqueued(conn, pid, channel, payload):
+    _scan_wakeup.set()
+
+# Claims a scan only when a SCAN_SEM slot is free, so a backlog stays in the
+# table instead of becoming a pile of waiting coroutines
+async def _consume_scans():
+    while True:
+        await SCAN_SEM.acquire()
+        if not await _ensure_browser():
+            # Leave the queue to healthy workers and retry the launch later
+            SCAN_SEM.release()
+            await asyncio.sleep(SWEEP_INTERVAL)
+            continue
+
+        claimed = None
+        try:
+            # Clear before claiming: a NOTIFY landing after this is either
+            # seen by the claim or re-sets the event for the wait below
+            _scan_wakeup.clear()
+            claimed = await pool.fetchrow(SQL_CLAIM_NEXT_SCAN, datetime.now(timezone.utc))
+        except Exception as e:
+            logger.error(f"Failed to claim a scan: {e}")
+
+        if claimed is None:
+            SCAN_SEM.release()
+            try:
+                await asyncio.wait_for(_scan_wakeup.wait(), SWEEP_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        scan_id = str(claimed['id'])
+        task = asyncio.create_task(_run_scan(scan_id, claimed['url'], claimed['attempts']))
+        SCAN_TASKS[scan_id] = task
+        task.add_done_callback(lambda _, scan_id=scan_id: _on_scan_done(scan_id))
+
+def _on_scan_done(scan_id: str):
+    SCAN_TASKS.pop(scan_id, None)
+    SCAN_SEM.release()
+
+# (Re)opens the LISTEN connection if it is missing or closed. LISTEN needs a
+# dedicated connection outside the pool.
+async def _ensure_listening():
+    global listen_conn
+    async with _listen_lock:
+        if listen_conn and not listen_conn.is_closed():
+            return
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn=listen_dsn)
+            await conn.add_listener(SCAN_CHANNEL, _on_scan_enqueued)
+            conn.add_termination_listener(_on_listen_conn_lost)
+            listen_conn = conn
+            logger.info(f"Listening for scans on {SCAN_CHANNEL}")
+
+            # Anything enqueued while we weren't listening never woke us
+            _scan_wakeup.set()
+        except Exception as e:
+            logger.error(f"Failed to listen on {SCAN_CHANNEL}, retrying on next sweep: {e}")
+            if conn is not None and conn is not listen_conn:
+                conn.terminate()
+
+def _on_listen_conn_lost(conn):
+    global relisten
+    if shutting_down:
+        return
+    logger.warning(f"Lost LISTEN connection on {SCAN_CHANNEL}, reconnecting")
+    relisten = asyncio.create_task(_ensure_listening())
+
+async def _sweep_stale_scans():
+    while True:
+        # Backstop for a LISTEN connection that dropped and failed to reconnect
+        await _ensure_listening()
+        try:
+            result = await pool.execute(SQL_REQUEUE_STALE_SCANS, STALE_SCAN_AFTER, MAX_SCAN_ATTEMPTS)
+            if result != "UPDATE 0":
+                _scan_wakeup.set()
+        except Exception as e:
+            logger.warning(f"Stale scan sweep failed: {e}")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+# Adaptive settle: after DOM ready, stop once no new cookie has been seen
+# (via Set-Cookie headers or the context cookie jar) for COOKIE_QUIET_PERIOD
+# seconds, capped at COOKIE_WAIT_CAP.
+COOKIE_POLL_INTERVAL = 0.5
+COOKIE_QUIET_PERIOD = float(os.getenv("COOKIE_QUIET_PERIOD_SECONDS", "1.5"))
+COOKIE_WAIT_CAP = float(os.getenv("COOKIE_WAIT_CAP_SECONDS", "10"))
+
+async def _wait_for_cookies_to_settle(context, page):
+    loop = asyncio.get_running_loop()
+    last_change = loop.time()
+    deadline = last_change + COOKIE_WAIT_CAP
+
+    def _on_response_extra_info(event):
+        nonlocal last_change
+        if any(k.lower() == "set-cookie" for k in event.get("headers", {})):
+            last_change = loop.time()
+
+    cdp = await context.new_cdp_session(page)
+    try:
+        cdp.on("Network.responseReceivedExtraInfo", _on_response_extra_info)
+        await cdp.send("Network.enable")
+
+        # Cookies set from JS never show up as headers, so also watch the jar
+        seen = len(await context.cookies())
+        while loop.time() < deadline:
+            await asyncio.sleep(COOKIE_POLL_INTERVAL)
+            count = len(await context.cookies())
+            if count != seen:
+                seen = count
+                last_change = loop.time()
+            elif loop.time() - last_change > COOKIE_QUIET_PERIOD:
+                break
+    finally:
+        try:
+            await cdp.detach()
+        except Exception:
+            # The page/target may already be gone; nothing left to clean up
+            pass
+
+async def _run_scan(scan_id: str, target_url: str, attempt: int):
     logger.info(f"Starting async background scan for {scan_id} -> {target_url}")
-    
-    start_time = datetime.now(timezone.utc)
-    
+
+    try:
+        raw_cookies, scan_error = await asyncio.wait_for(_collect_cookies(target_url), SCAN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Scan {scan_id} timed out after {SCAN_TIMEOUT}s on {target_url}")
+        raw_cookies, scan_error = [], f"Scan timed out after {SCAN_TIMEOUT}s"
+
+    # ────────────────────────────────────────────────────────
+    # Persist the output safely
+    # ────────────────────────────────────────────────────────
+    now = datetime.now(timezone.utc)
+    final_status = 'failed' if scan_error else 'completed'
+
+    logger.info(f"Scan {scan_id} {final_status} with {len(raw_cookies)} cookies. Insertions pending.")
+
     async with pool.acquire() as conn:
-        await conn.execute("""
-            UPDATE cookie_scans 
-            SET status = 'running', started_at = $2, updated_at = $2
-            WHERE id = $1
-        """, scan_id, start_time)
-        
-    extracted_cookies = []
+        async with conn.transaction():
+            result = await conn.execute(SQL_FINISH_SCAN, scan_id, final_status, scan_error, now, attempt)
+            if result == "UPDATE 0":
+                logger.warning(f"Scan {scan_id} was requeued or finished elsewhere - discarding attempt {attempt}")
+                return
+            
+            if raw_cookies:
+                # Pass UUID objects so asyncpg writes them as 16 binary bytes
+                scan_uuid = uuid.UUID(scan_id)
+                await conn.copy_records_to_table(
+                    'scanned_cookies',
+                    columns=[
+                        'id', 'scan_id', 'name', 'domain', 'path', 'value',
+                        'expiration', 'secure', 'http_only', 'same_site',
+                        'category'
+                    ],
+                    records=_cookie_rows(scan_uuid, raw_cookies)
+                )
+
+async def _collect_cookies(target_url: str):
+    raw_cookies = []
     scan_error = None
     
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(
-                headless=True,
-                args=[
-                    '--disable-blink-features=AutomationControlled',
-                    '--no-sandbox',
-                    '--disable-dev-shm-usage',
-                    '--disable-gpu',
-                    '--disable-setuid-sandbox',
-                    '--disable-web-security',
-                ]
-            )
-            context = await browser.new_context(
-                user_agent="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                viewport={'width': 1920, 'height': 1080},
-                device_scale_factor=1,
-            )
+        context = await browser.new_context(
+            user_agent="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+            viewport={'width': 1920, 'height': 1080},
+            device_scale_factor=1,
+        )
+        try:
+            await context.route("**/*", _block_heavy_resources)
             page = await context.new_page()
             
             try:
                 # 60s timeout for initial DOM load
                 await page.goto(target_url, wait_until="domcontentloaded", timeout=60000)
                 
-                # Human simulation
+                # Human simulation (triggers lazy-loaded trackers)
                 await page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-                await asyncio.sleep(3)
-                await page.evaluate("window.scrollTo(0, 0)")
                 
+                # Wait only as long as cookies keep arriving
                 try:
-                    await page.wait_for_load_state("networkidle", timeout=8000)
-                except Exception:
-                    logger.warning(f"Network idle timeout on {target_url} - proceeding anyway")
-                    pass
-                
-                # Final wait for trailing scripts
-                await asyncio.sleep(4)
+                    await _wait_for_cookies_to_settle(context, page)
+                except Exception as e:
+                    logger.warning(f"Cookie settle wait failed on {target_url} - proceeding anyway: {e}")
                 
             except Exception as e:
                 logger.warning(f"Navigation/timeout issue on {target_url}: {e}")
                 scan_error = str(e)
 
             raw_cookies = await context.cookies()
-            await browser.close()
+        finally:
+            await context.close()
             
-            # Map down Playwright cookies to DB row definitions
-            for c in raw_cookies:
-                exp = None
-                if c.get('expires', -1) > 0:
-                    exp = datetime.fromtimestamp(c['expires'], timezone.utc)
-                    
-                extracted_cookies.append({
-                    'id': str(uuid.uuid4()),
-                    'scan_id': scan_id,
-                    'name': c.get('name', ''),
-                    'domain': c.get('domain', ''),
-                    'path': c.get('path', '/'),
-                    'value': c.get('value', ''),
-                    'expiration': exp,
-                    'secure': bool(c.get('secure')),
-                    'http_only': bool(c.get('httpOnly')),
-                    'same_site': str(c.get('sameSite', '')),
-                    'source': 'headless_browser',
-                    'category': categorize_cookie(c.get('name', '')),
-                    'description': 'Automatically detected via PII Discovery',
-                })
-                
     except Exception as outer_e:
         logger.error(f"Playwright critical error on {target_url}: {outer_e}")
         scan_error = str(outer_e)
 
-    # ────────────────────────────────────────────────────────
-    # Persist the output safely
-    # ────────────────────────────────────────────────────────
-    now = datetime.now(timezone.utc)
-    final_status = 'failed' if scan_error else 'completed'
-
-    logger.info(f"Scan {scan_id} {final_status} with {len(extracted_cookies)} cookies. Insertions pending.")
-
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute("""
-                UPDATE cookie_scans 
-                SET status = $2, error = $3, completed_at = $4, updated_at = $4
-                WHERE id = $1
-            """, scan_id, final_status, scan_error, now)
-            
-            if extracted_cookies:
-                await conn.copy_records_to_table(
-                    'scanned_cookies',
-                    columns=[
-                        'id', 'scan_id', 'name', 'domain', 'path', 'value',
-                        'expiration', 'secure', 'http_only', 'same_site',
-                        'source', 'category', 'description'
-                    ],
-                    records=[
-                         (c['id'], c['scan_id'], c['name'], c['domain'], c['path'], c['value'],
-                          c['expiration'], c['secure'], c['http_only'], c['same_site'],
-                          c['source'], c['category'], c['description'])
-                         for c in extracted_cookies
-                    ]
-                )
+    return raw_cookies, scan_error
 
 # ── API ENDPOINTS ────────────────────────────────────────────────────────────
 
+# Reject malformed URLs up front so bulk submissions with junk never reach the DB
 class ScanRequest(BaseModel):
-    url: str
+    model_config = ConfigDict(str_strip_whitespace=True, extra="forbid", frozen=True)
+
+    url: AnyHttpUrl
 
 def get_tenant_from_req(req: Request) -> str:
     tid = req.headers.get("X-Internal-Org-Id", "")
@@ -194,47 +641,129 @@ def get_tenant_from_req(req: Request) -> str:
         tid = "00000000-0000-0000-0000-000000000000"
     return tid
 
+@app.get("/healthz")
+async def healthz():
+    return {
+        "status": "ok",
+        "scan_slots_total": MAX_CONCURRENT_SCANS,
+        "scan_slots_free": SCAN_SEM._value,
+        "scans_running": len(SCAN_TASKS),
+    }
+
+# Returns the id of a scan already submitted for this key, or None once
+# scan_id has been registered (or Redis is unavailable)
+async def _dedup_scan(key: str, scan_id: str) -> Optional[str]:
+    if not redis_client:
+        return None
+    try:
+        if await redis_client.set(key, scan_id, nx=True, ex=SCAN_DEDUP_TTL):
+            return None
+        return await redis_client.get(key)
+    except Exception as e:
+        logger.warning(f"Scan dedup unavailable, proceeding without it: {e}")
+        return None
+
+# Points the dedup key at the scan that was actually inserted
+async def _remember_dedup_scan(key: str, scan_id: str):
+    if not redis_client:
+        return
+    try:
+        await redis_client.set(key, scan_id, ex=SCAN_DEDUP_TTL)
+    except Exception as e:
+        logger.warning(f"Failed to update scan dedup key: {e}")
+
+# Drops a dedup key whose scan was never inserted
+async def _forget_dedup_scan(key: str):
+    if not redis_client:
+        return
+    try:
+        await redis_client.delete(key)
+    except Exception as e:
+        logger.warning(f"Failed to clear scan dedup key: {e}")
+
+# Waits briefly for the scan a dedup key points at to become visible
+async def _fetch_dedup_scan(scan_id: str):
+    for _ in range(SCAN_DEDUP_FETCH_RETRIES):
+        row = await pool.fetchrow(SQL_GET_SCAN, scan_id)
+        if row:
+            return row
+        await asyncio.sleep(SCAN_DEDUP_FETCH_DELAY)
+    return None
+
 @app.post("/scans")
-async def create_scan(req: Request, data: ScanRequest, bg_tasks: BackgroundTasks):
+async def create_scan(req: Request, data: ScanRequest):
     tid = get_tenant_from_req(req)
     scan_id = str(uuid.uuid4())
+    url = str(data.url)
+
+    key = f"arc:scan:{tid}:{hashlib.blake2b(url.encode(), digest_size=16).hexdigest()}"
+    existing = await _dedup_scan(key, scan_id)
+    if existing:
+        row = await _fetch_dedup_scan(existing)
+        if row is None:
+            # Still being inserted by the request that won the key
+            return RecordJSONResponse({"id": existing, "tenant_id": tid, "url": url, "status": "pending"})
+        # Only coalesce onto a scan that is still in flight; a finished one is re-run
+        if row['status'] in ('pending', 'running'):
+            return RecordJSONResponse(row)
     
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            INSERT INTO cookie_scans (id, tenant_id, url, status, created_at, updated_at)
-            VALUES ($1, $2, $3, 'pending', NOW(), NOW())
-            RETURNING *
-        """, scan_id, tid, data.url)
-        
-    bg_tasks.add_task(scan_worker, scan_id, data.url)
-    return dict(row)
+    try:
+        row = await pool.fetchrow(SQL_CREATE_SCAN, scan_id, tid, url)
+    except Exception:
+        if not existing:
+            # Our SET NX registered this id; don't leave it pointing at nothing
+            await _forget_dedup_scan(key)
+        raise
+    if existing:
+        # The key pointed at a finished scan; repoint it so repeats coalesce here
+        await _remember_dedup_scan(key, scan_id)
+    return RecordJSONResponse(row)
 
+# Keyset pagination: pass the created_at/id of the last row seen as
+# before/before_id to fetch the next page (before alone starts strictly before
+# that time). Served by idx_cookie_scans_tenant_created (migration 000002).
 @app.get("/scans")
-async def list_scans(req: Request):
+async def list_scans(
+    req: Request,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[datetime] = None,
+    before_id: Optional[uuid.UUID] = None,
+):
     tid = get_tenant_from_req(req)
-    async with pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT * FROM cookie_scans 
-            WHERE tenant_id = $1 
-            ORDER BY created_at DESC 
-            LIMIT 50 OFFSET 0
-        """, tid)
-    return [dict(r) for r in rows]
+    if before is None:
+        if before_id is not None:
+            raise HTTPException(status_code=422, detail="before_id requires before")
+        rows = await pool.fetch(SQL_LIST_SCANS_FIRST, tid, limit)
+    else:
+        # The nil UUID sorts first, so without before_id every row at `before` is excluded
+        rows = await pool.fetch(SQL_LIST_SCANS_NEXT, tid, before, before_id or uuid.UUID(int=0), limit)
+    return RecordJSONResponse(rows)
 
 @app.get("/scans/{id}")
 async def get_scan(id: str):
-    async with pool.acquire() as conn:
-        scan = await conn.fetchrow("SELECT * FROM cookie_scans WHERE id = $1", id)
-        if not scan:
-            raise HTTPException(status_code=404, detail="Scan not found")
-        
-        cookies = await conn.fetch("""
-            SELECT * FROM scanned_cookies 
-            WHERE scan_id = $1 
-            ORDER BY category, name
-        """, id)
-        
-    return {
-        "scan": dict(scan),
-        "cookies": [dict(c) for c in cookies]
-    }
+    scan = await pool.fetchrow(SQL_GET_SCAN, id)
+    if not scan:
+        raise HTTPException(status_code=404, detail="Scan not found")
+
+    # Serialize the scan before streaming starts so a failure here is still a 500
+    head = b'{"scan":' + orjson.dumps(scan, default=_orjson_default) + b',"cookies":['
+
+    # Cookies are streamed from a server-side cursor so memory stays flat on
+    # ad-heavy pages; the connection is held until the body is fully sent.
+    async def _gen():
+        yield head
+        try:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    sep = b''
+                    async for c in conn.cursor(SQL_GET_COOKIES, id):
+                        yield sep + orjson.dumps(c, default=_orjson_default)
+                        sep = b','
+        except Exception as e:
+            # Headers are already sent; log and abort the body rather than
+            # closing the JSON over a partial cookie list
+            logger.error(f"Failed streaming cookies for scan {id}: {e}")
+            raise
+        yield b']}'
+
+    return StreamingResponse(_gen(), media_type="application/json")
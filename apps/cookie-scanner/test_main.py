@@ -0,0 +1,218 @@
+import asyncio
+import uuid
+from datetime import datetime, timezone
+
+import orjson
+import pytest
+from fastapi import HTTPException
+from asyncpg.pgproto import pgproto
+
+import main
+
+
+def test_record_json_response_serializes_asyncpg_uuids():
+    scan_id = "6937eefe-7681-4f4c-95b0-aff7f37fe4e6"
+    tenant_id = "00000000-0000-0000-0000-000000000000"
+    created_at = datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+    row = {
+        "id": pgproto.UUID(scan_id),
+        "tenant_id": pgproto.UUID(tenant_id),
+        "status": "pending",
+        "created_at": created_at,
+    }
+
+    body = orjson.loads(main.RecordJSONResponse([row]).body)
+
+    assert body == [{
+        "id": scan_id,
+        "tenant_id": tenant_id,
+        "status": "pending",
+        "created_at": created_at.isoformat(),
+    }]
+
+
+def test_record_json_response_keeps_plain_uuids():
+    cookie_id = uuid.uuid4()
+    body = orjson.loads(main.RecordJSONResponse({"id": cookie_id}).body)
+    assert body == {"id": str(cookie_id)}
+
+
+def _use_cache_file(monkeypatch, tmp_path):
+    path = tmp_path / "dsn.json"
+    monkeypatch.setattr(main, "PG_URL_CACHE_FILE", str(path))
+    monkeypatch.setattr(main, "_pg_url_cache", {})
+    return path
+
+
+def test_pg_url_cache_round_trips_through_private_file(monkeypatch, tmp_path):
+    path = _use_cache_file(monkeypatch, tmp_path)
+    main._write_cached_pg_url("k", "postgres://cached")
+    main._pg_url_cache.clear()
+
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert main._read_cached_pg_url("k") == "postgres://cached"
+
+
+def test_pg_url_cache_ignores_readable_or_symlinked_files(monkeypatch, tmp_path):
+    path = _use_cache_file(monkeypatch, tmp_path)
+    main._write_cached_pg_url("k", "postgres://cached")
+    main._pg_url_cache.clear()
+
+    path.chmod(0o644)
+    assert main._read_cached_pg_url("k") is None
+
+    target = tmp_path / "elsewhere.json"
+    path.chmod(0o600)
+    path.rename(target)
+    path.symlink_to(target)
+    assert main._read_cached_pg_url("k") is None
+
+
+def test_list_scans_rejects_before_id_without_before():
+    class _Req:
+        headers = {}
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.list_scans(_Req(), limit=50, before=None, before_id=uuid.uuid4()))
+    assert exc.value.status_code == 422
+
+
+class _FakeConn:
+    def __init__(self, result):
+        self.result = result
+        self.executed = []
+        self.copied = False
+
+    async def execute(self, query, *args):
+        self.executed.append(args)
+        return self.result
+
+    async def copy_records_to_table(self, *args, **kwargs):
+        self.copied = True
+
+    def transaction(self):
+        return self
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def _fake_scan(monkeypatch, finish_result, collect):
+    conn = _FakeConn(finish_result)
+    monkeypatch.setattr(main, "pool", conn)
+    monkeypatch.setattr(main, "_collect_cookies", collect)
+    return conn
+
+
+def test_run_scan_skips_cookies_when_scan_was_requeued(monkeypatch):
+    async def collect(url):
+        return [{"name": "_ga", "domain": ".example.com"}], None
+
+    conn = _fake_scan(monkeypatch, "UPDATE 0", collect)
+    asyncio.run(main._run_scan(str(uuid.uuid4()), "https://example.com", 1))
+
+    assert conn.executed[0][-1] == 1
+    assert not conn.copied
+
+
+def test_run_scan_fails_scan_that_exceeds_timeout(monkeypatch):
+    async def collect(url):
+        await asyncio.sleep(10)
+
+    conn = _fake_scan(monkeypatch, "UPDATE 1", collect)
+    monkeypatch.setattr(main, "SCAN_TIMEOUT", 0.01)
+    asyncio.run(main._run_scan(str(uuid.uuid4()), "https://example.com", 2))
+
+    _, status, error, _, attempt = conn.executed[0]
+    assert (status, attempt) == ("failed", 2)
+    assert "timed out" in error
+
+
+class _FakeBrowser:
+    def __init__(self, connected=True):
+        self.connected = connected
+
+    def is_connected(self):
+        return self.connected
+
+    def on(self, event, handler):
+        pass
+
+
+def test_ensure_browser_relaunches_disconnected_browser(monkeypatch):
+    relaunched = _FakeBrowser()
+
+    class _Chromium:
+        async def launch(self, **kwargs):
+            return relaunched
+
+    class _Playwright:
+        chromium = _Chromium()
+
+    monkeypatch.setattr(main, "playwright", _Playwright())
+    monkeypatch.setattr(main, "browser", _FakeBrowser(connected=False))
+
+    assert asyncio.run(main._ensure_browser())
+    assert main.browser is relaunched
+
+
+class _FakeRedis:
+    def __init__(self, existing):
+        self.value = existing
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and self.value:
+            return False
+        self.value = value
+        return True
+
+    async def get(self, key):
+        return self.value
+
+
+class _FakeScanPool:
+    def __init__(self, existing_row):
+        self.existing_row = existing_row
+        self.created = []
+
+    async def fetchrow(self, query, *args):
+        if query == main.SQL_GET_SCAN:
+            return self.existing_row
+        self.created.append(args[0])
+        return {"id": args[0], "status": "pending"}
+
+
+def _create_scan(monkeypatch, existing_row):
+    class _Req:
+        headers = {}
+
+    existing = str(uuid.uuid4())
+    monkeypatch.setattr(main, "redis_client", _FakeRedis(existing))
+    monkeypatch.setattr(main, "pool", _FakeScanPool(existing_row and {**existing_row, "id": existing}))
+    resp = asyncio.run(main.create_scan(_Req(), main.ScanRequest(url="https://example.com")))
+    return existing, orjson.loads(resp.body)
+
+
+def test_create_scan_coalesces_onto_in_flight_scan(monkeypatch):
+    existing, body = _create_scan(monkeypatch, {"status": "running"})
+    assert body["id"] == existing
+    assert main.pool.created == []
+
+
+def test_create_scan_reruns_finished_scan(monkeypatch):
+    existing, body = _create_scan(monkeypatch, {"status": "completed"})
+    assert main.pool.created == [body["id"]]
+    assert main.redis_client.value == body["id"] != existing
+
+
+def test_create_scan_returns_pending_scan_not_yet_visible(monkeypatch):
+    monkeypatch.setattr(main, "SCAN_DEDUP_FETCH_DELAY", 0)
+    existing, body = _create_scan(monkeypatch, None)
+    assert (body["id"], body["status"]) == (existing, "pending")
+    assert main.pool.created == []
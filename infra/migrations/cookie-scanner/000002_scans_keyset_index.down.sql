@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS idx_cookie_scans_tenant_id ON cookie_scans(tenant_id);
+DROP INDEX IF EXISTS idx_cookie_scans_tenant_created;
@@ -0,0 +1,4 @@
+-- Keyset pagination for GET /scans: WHERE tenant_id = $1 AND (created_at, id) < (...)
+-- ORDER BY created_at DESC, id DESC. Supersedes the single-column tenant index.
+CREATE INDEX IF NOT EXISTS idx_cookie_scans_tenant_created ON cookie_scans(tenant_id, created_at DESC, id DESC);
+DROP INDEX IF EXISTS idx_cookie_scans_tenant_id;
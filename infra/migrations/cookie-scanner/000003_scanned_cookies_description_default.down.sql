@@ -0,0 +1 @@
+ALTER TABLE scanned_cookies ALTER COLUMN description DROP DEFAULT;
@@ -0,0 +1,3 @@
+-- Headless-browser rows carry a constant source/description; let Postgres fill
+-- them from column defaults so the scanner can omit both from its COPY payload.
+ALTER TABLE scanned_cookies ALTER COLUMN description SET DEFAULT 'Automatically detected via PII Discovery';
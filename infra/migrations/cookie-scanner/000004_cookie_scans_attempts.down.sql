@@ -0,0 +1 @@
+ALTER TABLE cookie_scans DROP COLUMN IF EXISTS attempts;
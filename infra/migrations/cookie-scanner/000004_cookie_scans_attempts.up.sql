@@ -0,0 +1,3 @@
+-- Number of times a worker has claimed the scan; stale scans are only
+-- requeued while this is below the scanner's MAX_SCAN_ATTEMPTS.
+ALTER TABLE cookie_scans ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
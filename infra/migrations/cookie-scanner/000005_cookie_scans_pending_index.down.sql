@@ -0,0 +1 @@
+DROP INDEX IF EXISTS idx_cookie_scans_pending_created;
@@ -0,0 +1,3 @@
+-- Scanner claim query: WHERE status = 'pending' ORDER BY created_at
+-- FOR UPDATE SKIP LOCKED LIMIT 1. Only the (small) pending set is indexed.
+CREATE INDEX IF NOT EXISTS idx_cookie_scans_pending_created ON cookie_scans(created_at) WHERE status = 'pending';